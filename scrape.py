@@ -18,9 +18,11 @@ import sys
 import csv
 import time
 import logging
+import random
 import re
 import requests
 import schedule
+from requests.adapters import HTTPAdapter
 import configparser
 import unicodedata
 from pathlib import Path
@@ -46,6 +48,11 @@ BATCH_SIZE = 10
 MAX_COMMENTS_PER_RUN = 30
 BASE_BACKOFF = 2.0
 MAX_BACKOFF = 30.0
+MAX_POST_ATTEMPTS = 5
+
+# Shared keep-alive pool: batched comment posts and alerts reuse one TLS connection
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=0))
 
 # ──────────────────────────────────────────────────────────────────────────────
 # LOGGING
@@ -80,25 +87,38 @@ if not ALERT_WEBHOOK:
 # ──────────────────────────────────────────────────────────────────────────────
 # CHAT HELPERS
 # ──────────────────────────────────────────────────────────────────────────────
+def _jittered(delay: float) -> float:
+    # Spread retries over [delay/2, delay] so concurrent CI runs don't retry in lockstep
+    return random.uniform(delay * 0.5, delay)
+
 def _post_with_backoff(url: str, payload: dict) -> bool:
     backoff = BASE_BACKOFF
+    failures = 0  # only connection errors count towards MAX_POST_ATTEMPTS; 429s are waited out
     while True:
         try:
-            r = requests.post(url, json=payload, timeout=20)
+            r = _SESSION.post(url, json=payload, timeout=20)
             if r.status_code == 200:
                 return True
             if r.status_code == 429:
-                delay = min(float(r.headers.get("Retry-After", backoff)), MAX_BACKOFF)
+                retry_after = r.headers.get("Retry-After")
+                if retry_after:
+                    delay = min(float(retry_after), MAX_BACKOFF) + random.uniform(0, 1.0)
+                else:
+                    delay = _jittered(backoff)
                 logger.error(f"429 from webhook — sleeping {delay:.1f}s")
                 time.sleep(delay)
-                backoff = min(backoff * 1.7, MAX_BACKOFF)
+                backoff = min(backoff * 2, MAX_BACKOFF)
                 continue
             logger.error(f"Webhook error {r.status_code}: {r.text[:300]}")
             return False
         except Exception as e:
-            logger.error(f"Webhook exception: {e}")
-            time.sleep(backoff)
-            backoff = min(backoff * 1.7, MAX_BACKOFF)
+            failures += 1
+            logger.error(f"Webhook exception: {e} (attempt {failures}/{MAX_POST_ATTEMPTS})")
+            if failures >= MAX_POST_ATTEMPTS:
+                logger.error(f"Webhook still unreachable after {MAX_POST_ATTEMPTS} attempts — giving up.")
+                return False
+            time.sleep(_jittered(backoff))
+            backoff = min(backoff * 2, MAX_BACKOFF)
 
 def alert(lines: List[str]):
     if not ALERT_WEBHOOK or "chat.googleapis.com" not in ALERT_WEBHOOK:
@@ -126,7 +146,10 @@ def dump_debug(page, tag):
 # ──────────────────────────────────────────────────────────────────────────────
 # 2FA EXTRACTION
 # ──────────────────────────────────────────────────────────────────────────────
-RE_TWO_OR_THREE = re.compile(r"(?<!\d)(\d{2,3})(?!\d)")
+RE_TWO_OR_THREE = re.compile(r"(?<![0-9])([0-9]{2,3})(?![0-9])")
+RE_MODEL_SUFFIX = re.compile(r"\b[0-9]{1,3}[A-Za-z]+\b")                          # 14T, 12S
+RE_MODEL_NAME   = re.compile(r"\b[0-9]{1,3}\s+(?:Pro|Pro\s?Max|Ultra|Plus)\b", re.I)  # 13 Pro
+RE_NEAR_HINT    = re.compile(r"(?:tap|number|verify)[^0-9]{0,20}([0-9]{1,3})", re.I)
 
 def _extract_numbers_from_buttons(page) -> List[str]:
     nums = []
@@ -154,16 +177,16 @@ def _extract_number_from_body(page) -> str:
         return ""
 
     # Remove model-like tokens such as "14T", "13 Pro", "12S Ultra"
-    cleaned = re.sub(r"\b\d{1,3}[A-Za-z]+\b", "", body)                 # 14T, 12S
-    cleaned = re.sub(r"\b\d{1,3}\s+(?:Pro|Pro\s?Max|Ultra|Plus)\b", "", cleaned, flags=re.I)
+    cleaned = RE_MODEL_SUFFIX.sub("", body)
+    cleaned = RE_MODEL_NAME.sub("", cleaned)
 
     # Prefer numbers that appear near guidance words
-    m = re.search(r"(?:tap|number|verify)[^\d]{0,20}(\d{1,3})", cleaned, re.IGNORECASE)
+    m = RE_NEAR_HINT.search(cleaned)
     if m:
         return m.group(1)
 
     # Fallback: any standalone 2–3 digit number
-    nums = re.findall(r"(?<!\d)(\d{2,3})(?!\d)", cleaned)
+    nums = RE_TWO_OR_THREE.findall(cleaned)
     for n in nums:
         if len(n) == 2:
             return n
@@ -289,9 +312,9 @@ def fetch_looker_text(page, url, tag):
 # ──────────────────────────────────────────────────────────────────────────────
 # PARSER
 # ──────────────────────────────────────────────────────────────────────────────
-DATE_PATTERN  = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+DATE_PATTERN  = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$")
 SCORE_PATTERN = re.compile(r"^(10|[0-9])$")
-STORE_PATTERN = re.compile(r"^\d+\s+.+")
+STORE_PATTERN = re.compile(r"^[0-9]+\s+.+")
 SKIP_PATTERN = re.compile(
     r"^(This|Last|Yesterday|go back|regional_manager|Privacy$|By |Lighthouse|You are about to|"
     r"Highly$|Satisfied$|Dissatisfied$|The data on this report|Showing results|Record Count|ⓘ|Net Promoter Score|"
@@ -301,17 +324,20 @@ SKIP_PATTERN = re.compile(
     re.IGNORECASE
 )
 
+# NBSP → space, zero-width space → dropped (single C-level pass)
+_NORM_TRANS = str.maketrans({"\u00A0": " ", "\u200B": None})
+
 def _norm(s: str) -> str:
     if s is None:
         return ""
-    s = s.replace("\u00A0", " ").replace("\u200B", "")
+    s = s.translate(_NORM_TRANS)
     s = unicodedata.normalize("NFKC", s)
     return s.strip()
 
 def parse_comments_from_lines(lines: List[str]) -> List[dict]:
     if not lines:
         return []
-    L = [_norm(x) for x in lines if _norm(x)]
+    L = [x for x in map(_norm, lines) if x]
     n = len(L)
     out: List[dict] = []
     i = 0
@@ -6,11 +6,13 @@ import sys
 import csv
 import time
 import logging
+import random
 import re
 import requests
 import schedule
 import configparser
 from getpass import getpass
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 from playwright.sync_api import (
@@ -96,32 +98,55 @@ DEFAULT_SELECTOR_TIMEOUT   = 30_000
 LOGIN_SUCCESS_TIMEOUT      = 120_000
 POST_NAVIGATION_WAIT       = 15_000
 
+# Line count of a frame's body text, and whether it is a login/permission prompt —
+# evaluated in-page so only the longest frame's text has to be sent back.
+FRAME_TEXT_STATS_JS = """() => {
+    const t = document.body ? document.body.innerText : "";
+    const lines = t ? t.replace(/\\n$/, "").split(/\\r\\n|\\r|\\n/).length : 0;
+    return [lines, /Please sign in|Can't access report|You need permission/.test(t)];
+}"""
+
 # Optional CI run URL injected by workflow
 CI_RUN_URL = os.getenv("CI_RUN_URL", "")
 
+# Shared keep-alive pool: one TLS connection for all per-complaint posts + alerts
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=0))
+
 # ──────────────────────────────────────────────────────────────────────────────
 # ALERT HELPERS
 # ──────────────────────────────────────────────────────────────────────────────
 def _post_with_backoff(url: str, payload: Dict[str, Any]) -> bool:
     backoff = 2.0
     max_backoff = 30.0
+    max_attempts = 5
+    failures = 0  # only connection errors count towards max_attempts; 429s are waited out
     while True:
         try:
-            r = requests.post(url, json=payload, timeout=20)
+            r = _SESSION.post(url, json=payload, timeout=20)
             if r.status_code == 200:
                 return True
             if r.status_code == 429:
-                delay = min(float(r.headers.get("Retry-After", backoff)), max_backoff)
+                retry_after = r.headers.get("Retry-After")
+                if retry_after:
+                    delay = min(float(retry_after), max_backoff) + random.uniform(0, 1.0)
+                else:
+                    # jitter so parallel runs don't hammer the webhook in lockstep
+                    delay = random.uniform(backoff * 0.5, backoff)
                 logger.error(f"429 from webhook — sleeping {delay:.1f}s")
                 time.sleep(delay)
-                backoff = min(backoff * 1.7, max_backoff)
+                backoff = min(backoff * 2, max_backoff)
                 continue
             logger.error(f"Webhook error {r.status_code}: {r.text[:300]}")
             return False
         except Exception as e:
-            logger.error(f"Webhook exception: {e}")
-            time.sleep(backoff)
-            backoff = min(backoff * 1.7, max_backoff)
+            failures += 1
+            logger.error(f"Webhook exception: {e} (attempt {failures}/{max_attempts})")
+            if failures >= max_attempts:
+                logger.error(f"Webhook still unreachable after {max_attempts} attempts — giving up.")
+                return False
+            time.sleep(random.uniform(backoff * 0.5, backoff))
+            backoff = min(backoff * 2, max_backoff)
 
 def send_alert(webhook_url: str, message: str):
     if not webhook_url or "chat.googleapis.com" not in webhook_url:
@@ -219,9 +244,12 @@ def copy_looker_studio_text(page, target_url: str) -> Optional[List[str]]:
             logger.warning("Login/permission prompt detected in body.")
             return None
 
-        # Try frames — prefer the longest plausible one
+        # Try frames — prefer the longest plausible one. Each frame only reports its line
+        # count (and whether it shows a login prompt); the text itself is fetched once,
+        # from the winning frame.
         best = page_text
         best_len = len(best.splitlines()) if best else 0
+        best_frame = None
         for i, frame in enumerate(page.frames):
             if i == 0:
                 continue
@@ -234,22 +262,22 @@ def copy_looker_studio_text(page, target_url: str) -> Optional[List[str]]:
                     plausible = False
                 if not plausible:
                     continue
-                try:
-                    frame.wait_for_selector("body", timeout=5_000)
-                    f_text = frame.locator("body").inner_text(timeout=30_000)
-                except PlaywrightTimeoutError:
-                    continue
-
-                if any(x in f_text for x in ("Please sign in", "Can't access report", "You need permission")):
+                f_len, blocked = frame.evaluate(FRAME_TEXT_STATS_JS)
+                if blocked:
                     logger.warning("Login/permission prompt detected in a frame.")
                     return None
 
-                f_len = len(f_text.splitlines())
                 if f_len > best_len + 10 or (f_len > 5 and best_len == 0):
-                    best, best_len = f_text, f_len
+                    best_frame, best_len = frame, f_len
             except Exception:
                 continue
 
+        if best_frame is not None:
+            try:
+                best = best_frame.locator("body").inner_text(timeout=30_000)
+            except Exception as e:
+                logger.warning(f"Could not read text from the longest frame ({e}); using the main body.")
+
         if not best:
             logger.warning("No text extracted from page or frames.")
             try:
@@ -278,17 +306,18 @@ def copy_looker_studio_text(page, target_url: str) -> Optional[List[str]]:
 # ──────────────────────────────────────────────────────────────────────────────
 # PARSER
 # ──────────────────────────────────────────────────────────────────────────────
+# Parser patterns (compiled once, reused across scheduled runs)
+DATE_RE = re.compile(r"^[0-9]{1,2}\s+(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+[0-9]{4},\s+[0-9]{2}:[0-9]{2}:[0-9]{2}$", re.I)
+CASE_NUM_RE = re.compile(r"^[0-9]+$")
+LIST_ITEM_RE = re.compile(r"^[0-9]+\.$")
+END_MARKER_RE = re.compile(r"^(Respond|under review|null)$", re.I)
+PAGINATION_RE = re.compile(r"^[0-9]+\s+-\s+[0-9]+\s*/\s*[0-9]+")
+HEADER_RE = re.compile(r"^(opened_date|store|case_number|dashboard_business_area|case_type|case_category|case_reason|detailed_case_reason|description|response_url|store_response)$", re.I)
+
 def parse_complaints_from_lines(lines: List[str]) -> List[Dict[str, str]]:
     if not lines:
         return []
 
-    date_re = re.compile(r"^\d{1,2}\s+(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+\d{4},\s+\d{2}:\d{2}:\d{2}$", re.I)
-    case_num_re = re.compile(r"^\d+$")
-    list_item_re = re.compile(r"^\d+\.$")
-    end_marker_re = re.compile(r"^(Respond|under review|null)$", re.I)
-    pagination_re = re.compile(r"^\d+\s+-\s+\d+\s*/\s*\d+")
-    header_re = re.compile(r"^(opened_date|store|case_number|dashboard_business_area|case_type|case_category|case_reason|detailed_case_reason|description|response_url|store_response)$", re.I)
-
     out: List[Dict[str, str]] = []
     n = len(lines)
     i = 0
@@ -301,16 +330,16 @@ def parse_complaints_from_lines(lines: List[str]) -> List[Dict[str, str]]:
         line = lines[i].strip()
         i += 1
 
-        if not line or pagination_re.match(line) or header_re.match(line):
+        if not line or PAGINATION_RE.match(line) or HEADER_RE.match(line):
             continue
 
         if state == "LOOKING_FOR_START":
-            if list_item_re.match(line):
+            if LIST_ITEM_RE.match(line):
                 state = "FOUND_LIST_ITEM"
             continue
 
         if state == "FOUND_LIST_ITEM":
-            if date_re.match(line):
+            if DATE_RE.match(line):
                 cur = {"opened_date": line}
                 desc, resp = [], []
                 state = "FOUND_DATE"
@@ -324,7 +353,7 @@ def parse_complaints_from_lines(lines: List[str]) -> List[Dict[str, str]]:
             continue
 
         if state == "FOUND_STORE":
-            if case_num_re.match(line):
+            if CASE_NUM_RE.match(line):
                 cur["case_number"] = line
                 state = "FOUND_CASE"
             else:
@@ -344,9 +373,9 @@ def parse_complaints_from_lines(lines: List[str]) -> List[Dict[str, str]]:
             cur["detailed_case_reason"] = line; state = "READING_DESC"; continue
 
         if state == "READING_DESC":
-            if end_marker_re.match(line) or list_item_re.match(line) or date_re.match(line):
+            if END_MARKER_RE.match(line) or LIST_ITEM_RE.match(line) or DATE_RE.match(line):
                 cur["description"] = "\n".join(desc).strip()
-                if list_item_re.match(line) or date_re.match(line):
+                if LIST_ITEM_RE.match(line) or DATE_RE.match(line):
                     cur["store_response"] = "[No response recorded]"
                     out.append(cur)
                     cur = {}
@@ -359,7 +388,7 @@ def parse_complaints_from_lines(lines: List[str]) -> List[Dict[str, str]]:
             continue
 
         if state == "READING_RESPONSE":
-            if list_item_re.match(line) or date_re.match(line):
+            if LIST_ITEM_RE.match(line) or DATE_RE.match(line):
                 cur["store_response"] = ("\n".join(resp).strip() or "[No response recorded]")
                 out.append(cur)
                 cur = {}
@@ -14,28 +14,49 @@ Key points in this build:
 """
 
 import os
+import operator
 import re
 import csv
 import json
+import hashlib
 import time
+import random
 import logging
+import threading
 import configparser
-from io import BytesIO
+from io import BytesIO, StringIO
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
-import requests
 from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 
-# --- GEMINI INTEGRATION IMPORTS ---
+# Optional faster JSON for Gemini replies and webhook payloads; stdlib json otherwise.
 try:
-    from google import genai
-    from google.genai import types
-    from PIL import Image
-    GEMINI_AVAILABLE = True
+    import orjson
 except ImportError:
-    GEMINI_AVAILABLE = False
-    class Image: pass # Placeholder for type hints
+    orjson = None
+
+def _json_loads(text):
+    return orjson.loads(text) if orjson else json.loads(text)
+
+# --- GEMINI INTEGRATION IMPORTS ---
+# Deferred to first use: the SDK and Pillow are slow to import, and a run that stops
+# early (e.g. no auth_state.json) never needs them.
+@lru_cache(maxsize=None)
+def _lazy_gemini():
+    """(genai, types, errors, Image) — all None if google-genai or Pillow is not installed."""
+    try:
+        from google import genai
+        from google.genai import types, errors
+        from PIL import Image
+        return genai, types, errors, Image
+    except ImportError:
+        return None, None, None, None
+
+def gemini_available() -> bool:
+    return _lazy_gemini()[0] is not None
 
 # --- Placeholder for compatibility/simplicity of the final script structure ---
 OCR_AVAILABLE = False
@@ -48,6 +69,13 @@ AUTH_STATE     = BASE_DIR / "auth_state.json"
 LOG_FILE       = BASE_DIR / "scrape_daily.log"
 DAILY_LOG_CSV  = BASE_DIR / "daily_report_log.csv"
 SCREENS_DIR    = BASE_DIR / "screens"
+GEMINI_CACHE_DIR = BASE_DIR / "gemini_cache"
+GEMINI_CACHE_MAX_BYTES = 500 * 1024 * 1024   # oldest entries are evicted past this
+GEMINI_CACHE_TTL_S     = float(os.getenv("GEMINI_CACHE_TTL_HOURS", "6")) * 3600
+
+# Screenshots go to Gemini straight from memory; the copies in screens/ are only for
+# debugging (uploaded as a workflow artifact). Set SAVE_SCREENS=0 to skip writing them.
+SAVE_SCREENS   = os.getenv("SAVE_SCREENS", "1").strip().lower() not in ("0", "false", "no")
 
 ENV_ROI_MAP    = os.getenv("ROI_MAP_FILE", "").strip()
 ROI_MAP_FILE   = Path(ENV_ROI_MAP) if ENV_ROI_MAP else (BASE_DIR / "roi_map.json")
@@ -59,7 +87,37 @@ DASHBOARD_URL = (
 )
 # !!! IMPORTANT !!!
 
-VIEWPORT = {"width": 1366, "height": 768}
+# Tall enough for a whole dashboard tab, so screenshots can be plain viewport captures
+# (full_page=True makes Chromium resize and repaint the page for every shot).
+VIEWPORT = {"width": 1600, "height": 1400}
+
+# The dashboard is rendered inside two nested iframes, both titled "Retail Wheel".
+DASHBOARD_FRAME    = 'iframe[title="Retail Wheel"]'
+DASHBOARD_LAYOUT   = "#dashboard-layout"
+# Requests that never affect the rendered numbers; aborting them speeds up page load.
+# Stylesheets, images and fonts are kept — the screenshots sent to Gemini need them
+# (a blocked icon font renders as its ligature text, e.g. "arrow_upward", beside the numbers).
+BLOCKED_RESOURCE_TYPES = {"media"}
+BLOCKED_URL_PARTS      = ("google-analytics.com", "googletagmanager.com", "doubleclick.net")
+# CI containers have a tiny /dev/shm (renderer crashes on big pages) and no GPU.
+BROWSER_ARGS           = ["--disable-dev-shm-usage", "--disable-gpu"]
+
+SETTLE_POLL_MS     = 500     # how often to sample the dashboard while it renders
+SETTLE_QUIET_MS    = 1500    # how long it must stay unchanged to count as rendered
+GEMINI_WORKERS     = 5       # wheel + 4 detail pages can all be in flight at once
+TAB_MARKER_TIMEOUT = 8_000   # ms to wait for a detail tab's marker label after clicking it
+# Image budget for Gemini: JPEG quality of every capture, and the longest side an image
+# may have before it is shrunk (larger images only cost more tiles, not legibility).
+SCREENSHOT_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+GEMINI_MAX_SIDE    = int(os.getenv("IMAGE_MAX_PIXEL_DIMENSION", "1600"))
+GEMINI_ATTEMPTS    = 4       # per request; 429 / 5xx / malformed JSON are retried with backoff
+WEBHOOK_ATTEMPTS   = 4       # chat webhook posts; a 429's Retry-After is honoured up to WEBHOOK_MAX_BACKOFF
+WEBHOOK_MAX_BACKOFF = 30.0   # seconds
+
+# One keep-alive pool for every webhook POST (alert, daily card, retries) so the
+# TLS handshake to chat.googleapis.com is paid once per run. Built (and requests
+# imported) on the first POST — see _get_session().
+_SESSION = None
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Logging
@@ -79,6 +137,7 @@ config = configparser.ConfigParser()
 config.read(BASE_DIR / "config.ini")
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", config["DEFAULT"].get("GEMINI_API_KEY"))
+GEMINI_MODEL   = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 
 MAIN_WEBHOOK  = config["DEFAULT"].get("DAILY_WEBHOOK") or config["DEFAULT"].get("MAIN_WEBHOOK", os.getenv("MAIN_WEBHOOK", ""))
 ALERT_WEBHOOK = config["DEFAULT"].get("ALERT_WEBHOOK",  os.getenv("ALERT_WEBHOOK", ""))
@@ -143,9 +202,14 @@ STATUS_CODE_MAP = {
     "BR": "BOLD_RED"
 }
 
+_COMMA_STRIP    = str.maketrans("", "", ",")
+_CURRENCY_STRIP = str.maketrans("", "", "£$€")
+_SUFFIX_MULT    = {"K": 1000.0, "M": 1_000_000.0, "B": 1_000_000_000.0}
+
+@lru_cache(maxsize=1024)
 def _clean_numeric_value(val: str, is_time_min: bool = False) -> Optional[float]:
     if not val or val == "—": return None
-    val = str(val).strip().replace(',', '')
+    val = str(val).strip().translate(_COMMA_STRIP)
     if is_time_min:
         parts = val.split(':')
         if len(parts) == 2:
@@ -153,138 +217,150 @@ def _clean_numeric_value(val: str, is_time_min: bool = False) -> Optional[float]
             except ValueError: return None
         try: return float(val)
         except ValueError: return None
-    val = re.sub(r'[£$€]', '', val).strip()
-    multiplier = 1.0
+    val = val.translate(_CURRENCY_STRIP).strip()
     val_clean = val.rstrip('%')
-    if val.endswith('K'): multiplier = 1000.0; val_clean = val_clean.rstrip('K')
-    elif val.endswith('M'): multiplier = 1_000_000.0; val_clean = val_clean.rstrip('M')
-    elif val.endswith('B'): multiplier = 1_000_000_000.0; val_clean = val_clean.rstrip('B')
+    multiplier = _SUFFIX_MULT.get(val[-1:])
+    if multiplier: val_clean = val_clean.rstrip(val[-1])
+    else: multiplier = 1.0
     try: return float(val_clean) * multiplier
     except ValueError: return None
 
+_RULE_RE = re.compile(r"A([<>])(-?[\d.]+)([KMB%]?|[M])?\s*(R|G|O|BR)", re.I)
+_STATUS_PRIORITY = ("BR", "R", "O", "G")
+_RULE_OPS = {">": operator.gt, "<": operator.lt}
+
+def _parse_rules(rule_str: str) -> List[Tuple[Callable[[float, float], bool], float, str]]:
+    parsed = []
+    for rule_segment in (r.strip() for r in rule_str.split(',')):
+        m = _RULE_RE.match(rule_segment)
+        if not m: continue
+        op, str_val, unit, status = m.groups()
+        is_min_target = (unit == 'M')
+        comp_target = _clean_numeric_value(str_val + (unit if unit != 'M' else ''), is_time_min=is_min_target)
+        if comp_target is not None:
+            parsed.append((_RULE_OPS[op], comp_target, status.upper()))
+    return parsed
+
+# METRIC_TARGETS never changes at runtime: parse every rule once at import.
+# key -> (value is a M:SS time, [(compare, target, status_letter), ...] highest priority first)
+_PARSED_RULES: Dict[str, Tuple[bool, List[Tuple[Callable[[float, float], bool], float, str]]]] = {
+    key: ("M" in rule_str, sorted(_parse_rules(rule_str), key=lambda r: _STATUS_PRIORITY.index(r[2])))
+    for key, (_, rule_str) in METRIC_TARGETS.items()
+}
+
+@lru_cache(maxsize=256)
 def get_status_formatting(key: str, value: str) -> Tuple[str, str]:
-    if key not in METRIC_TARGETS or value in [None, "—"]: return STATUS_FORMAT["NONE"]
-    _, rule_str = METRIC_TARGETS[key]
-    is_time = "M" in rule_str
+    if key not in _PARSED_RULES or value in [None, "—"]: return STATUS_FORMAT["NONE"]
+    is_time, rules = _PARSED_RULES[key]
     comp_value = _clean_numeric_value(value, is_time_min=is_time)
     if comp_value is None: return STATUS_FORMAT["NONE"]
-    rules = [r.strip() for r in rule_str.split(',')]
-    def check_rule(rule_segment, value, is_time):
-        m = re.match(r"A([<>])(-?[\d.]+)([KMB%]?|[M])?\s*(R|G|O|BR)", rule_segment, re.I)
-        if m:
-            op, str_val, unit, status = m.groups()
-            is_min_target = (unit == 'M')
-            comp_target = _clean_numeric_value(str_val + (unit if unit != 'M' else ''), is_time_min=is_min_target)
-            if comp_target is not None:
-                is_match = False
-                if op == '>' and value > comp_target: is_match = True
-                elif op == '<' and value < comp_target: is_match = True
-                if is_match: return status.upper()
-        return None
-    priority_statuses = ["BR", "R", "O", "G"]
-    for status_code_letter in priority_statuses:
-        for rule in rules:
-            status_letter = check_rule(rule, comp_value, is_time)
-            if status_letter == status_code_letter:
-                full_status = STATUS_CODE_MAP.get(status_letter)
-                if full_status: return STATUS_FORMAT[full_status]
+    # Rules are in priority order, so the first one that matches wins
+    for compare, comp_target, status_letter in rules:
+        if compare(comp_value, comp_target):
+            return STATUS_FORMAT[STATUS_CODE_MAP[status_letter]]
     return STATUS_FORMAT["NONE"]
 
 def format_metric_value(key: str, value: str) -> str:
     prefix, suffix = get_status_formatting(key, value)
-    return f"{prefix}{value}{suffix}"
+    # GREEN/NONE wrap nothing, so most values go out untouched
+    return prefix + value + suffix if prefix else value
 
 
 def kv(label: str, val: str, key: Optional[str] = None) -> dict:
-    formatted_val = format_metric_value(key, val) if key else (val or "—")
+    # Only metrics with a target can get a status colour; the rest are shown as-is.
+    formatted_val = format_metric_value(key, val) if key in METRIC_TARGETS else (val or "—")
     return {"decoratedText": {"topLabel": label, "text": formatted_val}}
 
 def title_widget(text: str) -> dict:
     return {"textParagraph": {"text": f"<b>{text}</b>"}}
 
-def _create_metric_widget(metrics: Dict[str, str], label: str, key: str, custom_val: Optional[str] = None) -> Optional[dict]:
+_BLANK = frozenset({"", "—", "-"})
+
+def _create_metric_widget(metrics: Dict[str, str], label: str, key: str,
+                          custom_val: Optional[Callable[[Dict[str, str]], str]] = None) -> Optional[dict]:
     val = metrics.get(key)
-    is_blank = (val is None or val.strip() == "" or val.strip() == "—" or val.strip() == "-")
+    if val is None or val.strip() in _BLANK: return None
 
     if custom_val:
-        vs_target_key = f"{key}_vs_target"
-        val_vs = metrics.get(vs_target_key)
-        is_vs_blank = (val_vs is None or val_vs.strip() == "" or val_vs.strip() == "—" or val_vs.strip() == "-")
-        is_complex_blank = is_blank or is_vs_blank
-        if is_complex_blank: return None
-        return {"decoratedText": {"topLabel": label, "text": custom_val}}
-
-    if is_blank: return None
+        val_vs = metrics.get(f"{key}_vs_target")
+        if val_vs is None or val_vs.strip() in _BLANK: return None
+        return {"decoratedText": {"topLabel": label, "text": custom_val(metrics)}}
+
     if val.upper() == "NPS": return None
     return kv(label, val, key=key)
 
+def _with_vs_target(key: str, vs_key: str) -> Callable[[Dict[str, str]], str]:
+    """Widget text builder: the coloured metric followed by its raw 'vs target' figure."""
+    return lambda m: f"{format_metric_value(key, m.get(key, '—'))} (vs {m.get(vs_key, '—')})"
+
+# Card layout is static; entries with a third element build their text from the metrics.
+_SECTION_DATA = [
+    {"title": None, "metrics": [
+        ("Report Time", "page_timestamp"),
+        ("Period", "period_range")
+    ]},
+    {"title": "Sales", "metrics": [
+        ("Sales Total", "sales_total"),
+        ("LFL", "sales_lfl"),
+        ("vs Target", "sales_vs_target"),
+    ]},
+    {"title": "Complaints & NPS", "metrics": [
+        ("Key Complaints", "complaints_key"),
+        ("Supermarket NPS", "supermarket_nps"),
+        ("Colleague Happiness", "colleague_happiness"),
+        ("Cafe NPS", "cafe_nps"),
+        ("Click & Collect NPS", "click_collect_nps"),
+        ("Customer Toilet NPS", "customer_toilet_nps"),
+        ("Home Delivery NPS", "home_delivery_nps"),
+    ]},
+    {"title": "Front End", "metrics": [
+        ("SCO Utilisation", "sco_utilisation"),
+        ("Efficiency", "efficiency"),
+        ("Scan Rate", "scan_rate", _with_vs_target("scan_rate", "scan_vs_target")),
+        ("Interventions", "interventions", _with_vs_target("interventions", "interventions_vs_target")),
+        ("Mainbank Closed", "mainbank_closed", _with_vs_target("mainbank_closed", "mainbank_vs_target")),
+        ("More card Swipe Rate", "swipe_rate"),
+        ("More card Swipes WOW %", "swipes_wow_pct"),
+    ]},
+    {"title": "Online", "metrics": [
+        ("C&C Availability", "availability_pct"),
+        ("Click & Collect Wait", "cc_avg_wait"),
+    ]},
+    {"title": "Waste & Markdowns (Total)", "metrics": [
+        ("Waste", "waste_total"),
+        ("Markdowns", "markdowns_total"),
+        ("Total", "wm_total"),
+        ("+/−", "wm_delta"),
+        ("Clean and rotate", "weekly_activity"),
+    ]},
+    {"title": "Payroll", "metrics": [
+        ("Payroll Outturn", "payroll_outturn"),
+        ("Absence Outturn", "absence_outturn"),
+        ("Productive Outturn", "productive_outturn"),
+        ("Holiday Outturn", "holiday_outturn"),
+    ]},
+    {"title": "Shrink", "metrics": [
+        ("Morrisons Order Adjustments", "moa"),
+        ("Waste Validation", "waste_validation"),
+        ("Unrecorded Waste %", "unrecorded_waste_pct"),
+        ("Shrink vs Budget %", "shrink_vs_budget_pct"),
+    ]},
+    {"title": "Production Plans", "metrics": [
+        ("Data Provided", "data_provided"),
+        ("Trusted Data", "trusted_data"),
+        ("My Reports", "my_reports")
+    ]},
+]
+
 def build_chat_card(metrics: Dict[str, str]) -> dict:
     header = {
         "title": "📊 Retail Daily Summary",
         "subtitle": (metrics.get("store_line") or "").replace("\n", "  "),
     }
 
-    section_data = [
-        {"title": None, "metrics": [
-            ("Report Time", "page_timestamp"),
-            ("Period", "period_range")
-        ]},
-        {"title": "Sales", "metrics": [
-            ("Sales Total", "sales_total"),
-            ("LFL", "sales_lfl"),
-            ("vs Target", "sales_vs_target"),
-        ]},
-        {"title": "Complaints & NPS", "metrics": [
-            ("Key Complaints", "complaints_key"),
-            ("Supermarket NPS", "supermarket_nps"),
-            ("Colleague Happiness", "colleague_happiness"),
-            ("Cafe NPS", "cafe_nps"),
-            ("Click & Collect NPS", "click_collect_nps"),
-            ("Customer Toilet NPS", "customer_toilet_nps"),
-            ("Home Delivery NPS", "home_delivery_nps"),
-        ]},
-        {"title": "Front End", "metrics": [
-            ("SCO Utilisation", "sco_utilisation"),
-            ("Efficiency", "efficiency"),
-            ("Scan Rate", "scan_rate", f"{format_metric_value('scan_rate', metrics.get('scan_rate','—'))} (vs {metrics.get('scan_vs_target','—')})"),
-            ("Interventions", "interventions", f"{format_metric_value('interventions', metrics.get('interventions','—'))} (vs {metrics.get('interventions_vs_target','—')})"),
-            ("Mainbank Closed", "mainbank_closed", f"{format_metric_value('mainbank_closed', metrics.get('mainbank_closed','—'))} (vs {metrics.get('mainbank_vs_target','—')})"),
-            ("More card Swipe Rate", "swipe_rate"),
-            ("More card Swipes WOW %", "swipes_wow_pct"),
-        ]},
-        {"title": "Online", "metrics": [
-            ("C&C Availability", "availability_pct"),
-            ("Click & Collect Wait", "cc_avg_wait"),
-        ]},
-        {"title": "Waste & Markdowns (Total)", "metrics": [
-            ("Waste", "waste_total"),
-            ("Markdowns", "markdowns_total"),
-            ("Total", "wm_total"),
-            ("+/−", "wm_delta"),
-            ("Clean and rotate", "weekly_activity"),
-        ]},
-        {"title": "Payroll", "metrics": [
-            ("Payroll Outturn", "payroll_outturn"),
-            ("Absence Outturn", "absence_outturn"),
-            ("Productive Outturn", "productive_outturn"),
-            ("Holiday Outturn", "holiday_outturn"),
-        ]},
-        {"title": "Shrink", "metrics": [
-            ("Morrisons Order Adjustments", "moa"),
-            ("Waste Validation", "waste_validation"),
-            ("Unrecorded Waste %", "unrecorded_waste_pct"),
-            ("Shrink vs Budget %", "shrink_vs_budget_pct"),
-        ]},
-        {"title": "Production Plans", "metrics": [
-            ("Data Provided", "data_provided"),
-            ("Trusted Data", "trusted_data"),
-            ("My Reports", "my_reports")
-        ]},
-    ]
-
     final_sections = []
 
-    for section in section_data:
+    for section in _SECTION_DATA:
         widgets = []
         for metric_data in section["metrics"]:
             label, key = metric_data[0], metric_data[1]
@@ -300,7 +376,7 @@ def build_chat_card(metrics: Dict[str, str]) -> dict:
 
     return {"cardsV2": [{"cardId": f"daily_{int(time.time())}", "card": {"header": header, "sections": final_sections}}]}
 
-CSV_HEADERS = [
+CSV_HEADERS = (
     "page_timestamp","period_range","store_line",
     "sales_total","sales_lfl","sales_vs_target",
     "supermarket_nps","colleague_happiness","home_delivery_nps","cafe_nps","click_collect_nps","customer_toilet_nps",
@@ -312,14 +388,16 @@ CSV_HEADERS = [
     "payroll_outturn","absence_outturn","productive_outturn","holiday_outturn","current_base_cost",
     "swipe_rate","swipes_wow_pct","new_customers","swipes_yoy_pct",
     "complaints_key","data_provided","trusted_data","my_reports","weekly_activity",
-]
+)
 
 def write_csv(metrics: Dict[str,str]):
-    write_header = not DAILY_LOG_CSV.exists() or DAILY_LOG_CSV.stat().st_size == 0
-    with open(DAILY_LOG_CSV, "a", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        if write_header: w.writerow(CSV_HEADERS)
-        w.writerow([metrics.get(h, "—") for h in CSV_HEADERS])
+    with open(DAILY_LOG_CSV, "a", newline="", encoding="utf-8", buffering=65536) as f:
+        # Format in memory and append with one write; fstat on the open handle replaces exists() + stat().
+        buf = StringIO()
+        w = csv.DictWriter(buf, fieldnames=CSV_HEADERS, restval="—", extrasaction="ignore")
+        if os.fstat(f.fileno()).st_size == 0: w.writeheader()
+        w.writerow(metrics)
+        f.write(buf.getvalue())
     log.info(f"Appended daily metrics row to {DAILY_LOG_CSV.name}")
 
 def send_card(metrics: Dict[str, str]) -> bool:
@@ -331,47 +409,89 @@ def send_card(metrics: Dict[str, str]) -> bool:
 # ──────────────────────────────────────────────────────────────────────────────
 # Browser automation
 # ──────────────────────────────────────────────────────────────────────────────
+_LAST_28_WEEKS_RE  = re.compile(r"^Last 28 Weeks$", re.I)
+_LAST_28_TEXT_RE   = re.compile(r"^\s*Last 28 Weeks\s*$", re.I)
+_OTHER_PERIOD_RE   = re.compile(r"Last 28 Days|Last 13 Weeks", re.I)
+
 def click_this_week(page):
-    try:
-        el = page.get_by_role("button", name=re.compile(r"^Last 28 Weeks$", re.I))
-        if el.count():
-            el.first.click(timeout=2000)
-            page.wait_for_timeout(600)
-            try:
-                page.get_by_role("button", name="Apply", exact=True).click(timeout=2000)
-                page.wait_for_timeout(1000)
-            except Exception: log.warning("Could not click 'Apply' button.")
-            return True
-    except Exception: pass
-    try:
-        el = page.get_by_text(re.compile(r"^\s*Last 28 Weeks\s*$", re.I))
-        if el.count():
+    # Tried in order; the first locator that matches anything is clicked, then "Apply".
+    strategies = (
+        ("button", lambda: page.get_by_role("button", name=_LAST_28_WEEKS_RE)),
+        ("text match fallback", lambda: page.get_by_text(_LAST_28_TEXT_RE)),
+        ("general date filter", lambda: page.get_by_role("button", name=_OTHER_PERIOD_RE)),
+    )
+    for how, make_locator in strategies:
+        try:
+            el = make_locator()
+            if not el.count(): continue
             el.first.click(timeout=2000)
             page.wait_for_timeout(600)
             try:
                 page.get_by_role("button", name="Apply", exact=True).click(timeout=2000)
                 page.wait_for_timeout(1000)
-            except Exception: log.warning("Could not click 'Apply' button in text match fallback.")
+            except Exception: log.warning(f"Could not click 'Apply' button after {how} click.")
             return True
-    except Exception: pass
-    try:
-        el = page.get_by_role("button", name=re.compile(r"Last 28 Days|Last 13 Weeks", re.I))
-        if el.count():
-             el.first.click(timeout=2000)
-             page.wait_for_timeout(600)
-             try:
-                page.get_by_role("button", name="Apply", exact=True).click(timeout=2000)
-                page.wait_for_timeout(1000)
-             except Exception: log.warning("Could not click 'Apply' button after general date filter click.")
-             return True
-    except Exception: pass
+        except Exception: continue
     log.info("Could not find and click any known 'Last' time period filter.")
     return False
 
 
-def click_proceed_overlays(page) -> int:
+def _block_nonessential(route):
+    req = route.request
+    if req.resource_type in BLOCKED_RESOURCE_TYPES or any(part in req.url for part in BLOCKED_URL_PARTS):
+        return route.abort()
+    return route.continue_()
+
+def _dashboard_frame(page):
+    return page.frame_locator(DASHBOARD_FRAME).frame_locator(DASHBOARD_FRAME)
+
+def wait_for_dashboard_settled(page, timeout_ms: int) -> bool:
+    """Poll the dashboard layout until its DOM/text stops changing for SETTLE_QUIET_MS.
+    Returns as soon as charts have rendered instead of always sleeping the worst case."""
+    layout = _dashboard_frame(page).locator(DASHBOARD_LAYOUT)
+    deadline = time.monotonic() + timeout_ms / 1000
+    last_size, stable_since = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        try:
+            size = layout.evaluate("el => el.textContent.length + el.getElementsByTagName('*').length", timeout=2000)
+        except Exception:
+            size = -1
+        now = time.monotonic()
+        if size != last_size:
+            last_size, stable_since = size, now
+        elif size > 0 and (now - stable_since) * 1000 >= SETTLE_QUIET_MS:
+            return True
+        page.wait_for_timeout(SETTLE_POLL_MS)
+    log.info(f"Dashboard still changing after {timeout_ms // 1000}s — continuing anyway.")
+    return False
+
+def dashboard_fingerprint(page) -> Optional[str]:
+    """Current text of the dashboard layout, used to tell whether a tab click changed the page."""
+    try:
+        return _dashboard_frame(page).locator(DASHBOARD_LAYOUT).evaluate("el => el.textContent", timeout=2000)
+    except Exception:
+        return None
+
+# Clicks every leaf element reading exactly "PROCEED" in one round-trip per frame.
+_PROCEED_JS = """() => {
+    let n = 0;
+    for (const el of document.querySelectorAll('body *')) {
+        if (el.childElementCount === 0 && el.textContent.trim() === 'PROCEED') { el.click(); n++; }
+    }
+    return n;
+}"""
+
+def click_proceed_overlays(page, real_clicks: bool = False) -> int:
+    """Dismiss PROCEED overlays. The in-page el.click() is fast but synthetic; real_clicks
+    uses Playwright's pointer clicks instead, for overlays that ignored the synthetic pass."""
     clicked = 0
     for fr in page.frames:
+        if not real_clicks:
+            try:
+                clicked += fr.evaluate(_PROCEED_JS)
+                continue
+            except Exception:
+                pass  # frame detached mid-scan or scripts blocked — fall back to locator clicks
         try:
             btn = fr.get_by_text("PROCEED", exact=True)
             for i in range(btn.count()):
@@ -386,27 +506,31 @@ def click_proceed_overlays(page) -> int:
         page.wait_for_timeout(1200)
     return clicked
 
-def open_and_prepare(page) -> bool:
+def open_and_prepare(page) -> Optional[str]:
+    """Load the dashboard and dismiss overlays. Returns the page body text (read once,
+    reused by the caller for context parsing) or None if the dashboard failed to load."""
     log.info("Opening Retail Performance Dashboard…")
     try:
-        page.goto(DASHBOARD_URL, wait_until="domcontentloaded", timeout=120_000)
+        # "commit" returns once the response starts; the dashboard-layout wait below is the
+        # real readiness signal, so there's no point also blocking on DOMContentLoaded.
+        page.goto(DASHBOARD_URL, wait_until="commit", timeout=120_000)
     except PlaywrightTimeoutError:
         log.error("Timeout loading dashboard.")
-        return False
+        return None
 
     if "accounts.google.com" in page.url:
         log.warning("Redirected to login — auth state missing/invalid.")
-        return False
+        return None
 
     # --- FINAL FIX: Wait for the correct nested iframe and then for the dashboard layout to be visible ---
     log.info("Waiting for dashboard iframe to load...")
     try:
         # As discovered, the dashboard is inside two nested iframes both titled "Retail Wheel".
-        iframe_locator = page.frame_locator('iframe[title="Retail Wheel"]').frame_locator('iframe[title="Retail Wheel"]')
+        iframe_locator = _dashboard_frame(page)
 
         # To confirm the content is truly ready, we wait for the main layout container of the dashboard.
         # This is a robust check that confirms the dashboard is loaded and ready.
-        iframe_locator.locator("#dashboard-layout").wait_for(state="visible", timeout=60000)
+        iframe_locator.locator(DASHBOARD_LAYOUT).wait_for(state="visible", timeout=60000)
         
         log.info("Dashboard iframe content is visible.")
         
@@ -415,15 +539,18 @@ def open_and_prepare(page) -> bool:
         # check above is sufficient.
 
     except PlaywrightTimeoutError as e:
+        if "accounts.google.com" in page.url:
+            log.warning("Redirected to login while loading — auth state missing/invalid.")
+            return None
         log.error(f"Timeout waiting for iframe content to load. The page's iframe structure may have changed. Error: {e}")
-        return False
+        return None
 
     log.info("Dashboard successfully loaded.")
 
-    # A short, static wait is still useful to ensure any final chart animations or
-    # late-loading elements have finished rendering before we take a screenshot.
-    log.info("Waiting 10s for dynamic content to finish rendering…")
-    page.wait_for_timeout(10_000)
+    # Charts and late-loading elements keep rendering after the layout is visible;
+    # wait until the layout stops changing (capped at the old fixed 10s).
+    log.info("Waiting for dynamic content to finish rendering…")
+    wait_for_dashboard_settled(page, timeout_ms=10_000)
 
     click_this_week(page)
     click_proceed_overlays(page)
@@ -432,31 +559,223 @@ def open_and_prepare(page) -> bool:
         body = page.inner_text("body")
     except Exception: body = ""
     if "You are about to interact with a community visualisation" in body:
-        log.info("Community visualisation placeholders detected — retrying PROCEED and waiting longer.")
-        click_proceed_overlays(page)
+        log.info("Community visualisation placeholders detected — retrying PROCEED with real clicks and waiting longer.")
+        click_proceed_overlays(page, real_clicks=True)
         page.wait_for_timeout(1500)
+        # Placeholders were swapped for real content — the cached text is stale.
+        try:
+            body = page.inner_text("body")
+        except Exception: body = ""
 
-    return True
+    return body
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Gemini Vision Extraction (Combined Logic)
 # ──────────────────────────────────────────────────────────────────────────────
-def _extract_gemini_vision(image_path: Path, prompt_map: Dict[str, str], system_instruction: str) -> Dict[str, str]:
-    if not GEMINI_AVAILABLE or not GEMINI_API_KEY:
+def _valid_roi(roi) -> bool:
+    if isinstance(roi, dict):
+        return isinstance(roi.get("selector"), str) and bool(roi["selector"].strip())
+    return (isinstance(roi, list) and len(roi) == 4
+            and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in roi))
+
+def load_roi_map() -> Dict[str, object]:
+    """Optional crop regions keyed by screenshot suffix (e.g. "nps_detail"): either a fractional
+    [x, y, w, h] box of the captured image — same convention as the per-metric entries — or
+    {"selector": "<css>"} naming an element inside the dashboard frame to capture on its own."""
+    if not ROI_MAP_FILE.exists(): return {}
+    try:
+        data = json.loads(ROI_MAP_FILE.read_text(encoding="utf-8"))
+    except Exception as e:
+        log.warning(f"Could not read {ROI_MAP_FILE.name}, screenshots will not be cropped: {e}")
+        return {}
+    if not isinstance(data, dict): return {}
+    roi_map = {}
+    for key, roi in data.items():
+        if _valid_roi(roi):
+            roi_map[key] = roi
+        else:
+            log.warning(f"Ignoring {ROI_MAP_FILE.name} entry {key!r}: expected [x, y, w, h] or {{\"selector\": \"<css>\"}}, got {roi!r}")
+    return roi_map
+
+def crop_to_roi(jpg: bytes, box: List[float]) -> bytes:
+    Image = _lazy_gemini()[3]
+    if Image is None: return jpg
+    try:
+        x, y, w, h = (float(v) for v in box)
+        img = Image.open(BytesIO(jpg))
+        W, H = img.size
+        cropped = img.crop((int(x * W), int(y * H), int(min(x + w, 1.0) * W), int(min(y + h, 1.0) * H)))
+        buf = BytesIO()
+        cropped.save(buf, format="JPEG", quality=SCREENSHOT_QUALITY)
+        return buf.getvalue()
+    except Exception as e:
+        log.warning(f"Invalid ROI box {box!r}, sending the full screenshot: {e}")
+        return jpg
+
+def _element_screenshot(page, selector: str) -> bytes:
+    """Capture one element inside the dashboard frame; Playwright clips to its bounding box."""
+    return _dashboard_frame(page).locator(selector).first.screenshot(type="jpeg", quality=SCREENSHOT_QUALITY, timeout=5000)
+
+def capture_screenshot(page, ts: int, suffix: str, roi_map: Dict[str, object]) -> bytes:
+    """Screenshot the page's ROI (element selector or crop box), or just the dashboard layout
+    when none is configured. Returns the JPEG bytes; a copy is written to screens/ when
+    SAVE_SCREENS is on."""
+    roi, jpg = roi_map.get(suffix), None
+    if isinstance(roi, dict) and roi.get("selector"):
+        try:
+            jpg = _element_screenshot(page, roi["selector"])
+        except Exception as e:
+            log.warning(f"ROI selector {roi['selector']!r} not captured for {suffix}, using the dashboard layout: {e}")
+    elif roi is not None:
+        # ROI boxes are fractions of the whole viewport capture
+        jpg = crop_to_roi(page.screenshot(type="jpeg", quality=SCREENSHOT_QUALITY), roi)
+    if jpg is None:
+        try:
+            jpg = _element_screenshot(page, DASHBOARD_LAYOUT)
+        except Exception as e:
+            log.info(f"Dashboard element screenshot failed for {suffix}, using the whole page: {e}")
+            jpg = page.screenshot(type="jpeg", quality=SCREENSHOT_QUALITY)
+    if SAVE_SCREENS:
+        save_bytes(SCREENS_DIR / f"{ts}_{suffix}.jpg", jpg)
+    return jpg
+
+def _load_for_gemini(jpg: bytes):
+    """Screenshot as a Gemini JPEG part. Images that already fit within GEMINI_MAX_SIDE are
+    passed through untouched; larger ones are shrunk (aspect kept) and re-encoded first."""
+    _, types, _, Image = _lazy_gemini()
+    img = Image.open(BytesIO(jpg))  # lazy: only the header is read until the pixels are needed
+    if max(img.size) > GEMINI_MAX_SIDE:
+        img.thumbnail((GEMINI_MAX_SIDE, GEMINI_MAX_SIDE), Image.LANCZOS)
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=SCREENSHOT_QUALITY)
+        jpg = buf.getvalue()
+    return types.Part.from_bytes(data=jpg, mime_type="image/jpeg")
+
+_GEMINI_CLIENT = None
+_GEMINI_CLIENT_LOCK = threading.Lock()
+
+def _get_gemini_client():
+    """One client (and its HTTP connection pool) shared by every extraction thread."""
+    global _GEMINI_CLIENT
+    with _GEMINI_CLIENT_LOCK:
+        if _GEMINI_CLIENT is None:
+            _GEMINI_CLIENT = _lazy_gemini()[0].Client(api_key=GEMINI_API_KEY)
+        return _GEMINI_CLIENT
+
+def _is_rate_limited(e: Exception) -> bool:
+    """429 — request rate or quota exhausted (RESOURCE_EXHAUSTED)."""
+    genai_errors = _lazy_gemini()[2]
+    return isinstance(e, genai_errors.ClientError) and e.code == 429
+
+def _is_transient(e: Exception) -> bool:
+    """Rate limiting, server-side failures and truncated JSON are worth another try."""
+    genai_errors = _lazy_gemini()[2]
+    if isinstance(e, (json.JSONDecodeError, genai_errors.ServerError)):
+        return True
+    return _is_rate_limited(e)
+
+def _generate_json(contents: list, config, what: str):
+    """generate_content + JSON parse, retried with jittered exponential backoff on transient errors."""
+    client = _get_gemini_client()
+    for attempt in range(1, GEMINI_ATTEMPTS + 1):
+        try:
+            response = client.models.generate_content(model=GEMINI_MODEL, contents=contents, config=config)
+            return _json_loads(response.text)
+        except Exception as e:
+            if attempt == GEMINI_ATTEMPTS or not _is_transient(e):
+                log.error(f"Gemini request for {what} failed after {attempt} attempt(s): {e}")
+                raise
+            wait_time = 2 ** (attempt - 1) + random.random()
+            log.warning(f"Gemini request for {what} failed ({e}); retrying in {wait_time:.1f}s...")
+            time.sleep(wait_time)
+
+# Extraction results keyed by a hash of the exact screenshots + prompts, one JSON file per
+# key in gemini_cache/, so a rerun with identical pixels is not paid for twice.
+# Entries are {"saved_at": epoch seconds, "metrics": {...}} and expire after GEMINI_CACHE_TTL_S.
+_GEMINI_CACHE_LOCK = threading.Lock()
+
+def _result_cache_key(images: List[bytes], *prompt) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for jpg in images:
+        h.update(hashlib.blake2b(jpg, digest_size=16).digest())
+    h.update(repr((GEMINI_MODEL,) + prompt).encode("utf-8"))
+    return h.hexdigest()
+
+def _cached_result(key: str) -> Optional[Dict[str, str]]:
+    path = GEMINI_CACHE_DIR / f"{key}.json"
+    with _GEMINI_CACHE_LOCK:
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f"Ignoring unreadable Gemini cache entry {path.name}: {e}")
+            try: path.unlink(missing_ok=True)
+            except OSError: pass
+            return None
+        try:
+            if not (isinstance(entry, dict) and isinstance(entry.get("saved_at"), (int, float))
+                    and isinstance(entry.get("metrics"), dict)):
+                log.warning(f"Discarding malformed Gemini cache entry {path.name}.")
+                path.unlink(missing_ok=True)
+                return None
+            if time.time() - entry["saved_at"] > GEMINI_CACHE_TTL_S:
+                path.unlink(missing_ok=True)
+                return None
+            metrics = {str(k): str(v) for k, v in entry["metrics"].items()}
+        except Exception as e:
+            log.warning(f"Ignoring Gemini cache entry {path.name}: {e}")
+            return None
+        try: os.utime(path)  # mark as recently used for eviction
+        except OSError: pass
+    log.info("Gemini result reused for an unchanged screenshot.")
+    return metrics
+
+def _evict_gemini_cache():
+    """Delete least-recently-used entries until the cache directory fits GEMINI_CACHE_MAX_BYTES."""
+    entries = []
+    for f in GEMINI_CACHE_DIR.glob("*.json"):
+        st = f.stat()
+        entries.append((st.st_mtime, st.st_size, f))
+    total = sum(size for _, size, _ in entries)
+    for _, size, f in sorted(entries):
+        if total <= GEMINI_CACHE_MAX_BYTES: break
+        f.unlink(missing_ok=True)
+        total -= size
+
+def _store_result(key: str, extracted: Dict[str, str]):
+    if not extracted: return
+    entry = {"saved_at": time.time(), "metrics": dict(extracted)}
+    with _GEMINI_CACHE_LOCK:
+        try:
+            GEMINI_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            (GEMINI_CACHE_DIR / f"{key}.json").write_text(json.dumps(entry), encoding="utf-8")
+            _evict_gemini_cache()
+        except Exception as e:
+            log.warning(f"Could not write Gemini cache entry: {e}")
+
+def _extract_gemini_vision(jpg: bytes, prompt_map: Dict[str, str], system_instruction: str) -> Dict[str, str]:
+    if not gemini_available() or not GEMINI_API_KEY:
         log.warning("Gemini API not available or key missing. Skipping AI extraction.")
         return {}
+    types = _lazy_gemini()[1]
 
-    if not image_path.exists():
-        log.error(f"Image not found at {image_path}. Cannot perform vision extraction.")
+    if not jpg:
+        log.error(f"Empty screenshot. Cannot perform vision extraction for {list(prompt_map.keys())}.")
         return {}
+
+    cache_key = _result_cache_key([jpg], tuple(prompt_map.items()), system_instruction)
+    cached = _cached_result(cache_key)
+    if cached is not None: return cached
+
+    img = _load_for_gemini(jpg)
     
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    img = Image.open(image_path)
-    
-    generation_config = genai.types.GenerationConfig(
+    generation_config = types.GenerateContentConfig(
         response_mime_type="application/json",
-        response_schema={v: genai.types.Schema(type=genai.types.Type.STRING) for v in prompt_map.keys()}
+        response_schema=types.Schema(
+            type=types.Type.OBJECT,
+            properties={k: types.Schema(type=types.Type.STRING) for k in prompt_map.keys()},
+        ),
     )
     
     prompt_parts = [
@@ -467,8 +786,7 @@ def _extract_gemini_vision(image_path: Path, prompt_map: Dict[str, str], system_
     ]
     
     try:
-        response = model.generate_content(prompt_parts, generation_config=generation_config)
-        ai_data = json.loads(response.text)
+        ai_data = _generate_json(prompt_parts, generation_config, str(list(prompt_map.keys())))
         
         extracted = {}
         for ai_key, ai_val in ai_data.items():
@@ -476,25 +794,106 @@ def _extract_gemini_vision(image_path: Path, prompt_map: Dict[str, str], system_
             if python_key and ai_val is not None:
                 extracted[python_key] = str(ai_val).strip()
                 log.info(f"Gemini Success: {python_key} -> {extracted[python_key]}")
-        
+
+        # A partial answer is used for this run but not cached, so a rerun asks again
+        if set(prompt_map.values()) <= extracted.keys():
+            _store_result(cache_key, extracted)
         return extracted
 
     except Exception as e:
         log.error(f"Gemini Vision API Error for {list(prompt_map.keys())}: {e}")
         return {}
 
+Shot = Tuple[str, bytes, Dict[str, str], str]  # (page name, JPEG, prompt map, system instruction)
+
+def _extract_gemini_vision_combined(shots: List[Shot]) -> Tuple[Dict[str, str], List[Shot]]:
+    """One request for every captured page: each image is followed by its own instruction, and
+    the schema keys are namespaced by page ("NPS::Supermarket NPS") so identical labels on
+    different pages stay apart. Returns (metrics, pages to retry one by one): every page when
+    the combined call fails or comes back empty, only the pages with missing keys after a
+    partial answer, and none after rate limiting — more requests on the same key would only
+    make the 429s worse."""
+    if not gemini_available() or not GEMINI_API_KEY or not shots:
+        return {}, shots
+    types = _lazy_gemini()[1]
+
+    cache_key = _result_cache_key([jpg for _, jpg, _, _ in shots],
+                                  tuple((name, tuple(pm.items()), si) for name, _, pm, si in shots))
+    cached = _cached_result(cache_key)
+    if cached is not None: return cached, []
+
+    prompt_parts, properties = [], {}
+    for n, (page_name, jpg, prompt_map, system_instruction) in enumerate(shots, 1):
+        if not jpg:
+            log.error(f"Empty screenshot for the {page_name} page. Cannot perform combined extraction.")
+            return {}, shots
+        keys = [f"{page_name}::{label}" for label in prompt_map]
+        properties.update((k, types.Schema(type=types.Type.STRING)) for k in keys)
+        prompt_parts += [
+            _load_for_gemini(jpg),
+            f"Image {n} is the '{page_name}' page. {system_instruction.strip()} "
+            f"Keys for this image: {keys}",
+        ]
+    prompt_parts.append(
+        "Return the exact values for every key listed above as a single JSON object. "
+        "Read each key only from the image named by its prefix. For percentages, include '%'."
+    )
+
+    generation_config = types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=types.Schema(type=types.Type.OBJECT, properties=properties),
+    )
 
-def parse_context_from_lines(lines: List[str]) -> Dict[str, str]:
+    try:
+        ai_data = _generate_json(prompt_parts, generation_config, "all pages")
+        if not isinstance(ai_data, dict) or not ai_data:
+            log.warning("Combined Gemini response was empty or not an object.")
+            return {}, shots
+    except Exception as e:
+        if _is_rate_limited(e):
+            log.error(f"Combined Gemini request was rate limited; skipping the per-page fallback: {e}")
+            return {}, []
+        log.warning(f"Combined Gemini request failed: {e}")
+        return {}, shots
+
+    # Merge page by page so later pages still win on key clashes, as with separate requests
+    extracted: Dict[str, str] = {}
+    incomplete: List[Shot] = []
+    for shot in shots:
+        page_name, _, prompt_map, _ = shot
+        missing = False
+        for label, python_key in prompt_map.items():
+            ai_val = ai_data.get(f"{page_name}::{label}")
+            if ai_val is None:
+                missing = True
+                continue
+            extracted[python_key] = str(ai_val).strip()
+            log.info(f"Gemini Success: {python_key} -> {extracted[python_key]}")
+        if missing:
+            incomplete.append(shot)
+    # Only a complete answer is cached; a partial one would be replayed on every rerun
+    if not incomplete:
+        _store_result(cache_key, extracted)
+    return extracted, incomplete
+
+
+# Context patterns run once per scrape over the whole body text. The gap between
+# the e-mail and the store cell is capped at 2000 chars, well above any plausible
+# header layout, so a miss can't backtrack across the rest of the page.
+_STORE_RE  = re.compile(r"([A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,})[\s\S]{0,2000}?\|\s*([^\|]+?)\s*\|\s*([0-9]{4}-[0-9]{2}-[0-9]{2}\s+[0-9]{2}:[0-9]{2}:[0-9]{2})")
+_TS_RE     = re.compile(r"\b([0-9]{1,2}\s+[A-Za-z]{3}\s+[0-9]{4},\s*[0-9]{2}:[0-9]{2}:[0-9]{2})\b")
+_PERIOD_RE = re.compile(r"Dates included:\s*([^\n]+)", re.I)
+
+def parse_context(text: str) -> Dict[str, str]:
     m: Dict[str, str] = {}
-    joined = "\n".join(lines)
 
-    z = re.search(r"([A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}).*?\|\s*([^\|]+?)\s*\|\s*(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2})", joined, re.S)
+    z = _STORE_RE.search(text)
     m["store_line"] = z.group(0).strip() if z else "—"
 
-    ts_match = re.search(r"\b(\d{1,2}\s+[A-Za-z]{3}\s+\d{4},\s*\d{2}:\d{2}:\d{2})\b", joined)
+    ts_match = _TS_RE.search(text)
     m["page_timestamp"] = ts_match.group(1) if ts_match else "—"
 
-    period_match = re.search(r"Dates included:\s*([^\n]+)", joined, re.I)
+    period_match = _PERIOD_RE.search(text)
     m["period_range"] = period_match.group(1).strip() if period_match else "—"
 
     return m
@@ -508,34 +907,48 @@ def run_daily_scrape():
         log.error("auth_state.json not found.")
         return
 
-    if not GEMINI_AVAILABLE:
+    if not gemini_available():
         alert(["⚠️ Gemini library (google-genai) is not installed. Please install it to use the AI features."])
 
     if not GEMINI_API_KEY:
         alert(["⚠️ Gemini API Key is missing. Check your GitHub Secrets/Environment variables."])
 
-    all_metrics: Dict[str,str] = {}
+    # Every CSV column starts as "—"; extraction results overwrite what they find.
+    all_metrics: Dict[str,str] = dict.fromkeys(CSV_HEADERS, "—")
 
     with sync_playwright() as p:
-        browser = context = page = None
+        browser = context = page = gemini_pool = None
         try:
-            browser = p.chromium.launch(headless=True)
+            browser = p.chromium.launch(headless=True, args=BROWSER_ARGS)
             context = browser.new_context(
                 storage_state=str(AUTH_STATE),
                 viewport=VIEWPORT,
                 user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
             )
+            context.route("**/*", _block_nonessential)
             page = context.new_page()
-            if not open_and_prepare(page):
+            body_text = open_and_prepare(page)
+            if body_text is None:
                 alert(["⚠️ Daily scrape blocked by load failure. Please check iframe locators in the script."])
                 return
 
+            # The session loaded fine — save the refreshed cookies so the next run (and the
+            # workflow cache) starts from the newest state rather than the one from first login.
+            try:
+                context.storage_state(path=str(AUTH_STATE))
+            except Exception as e:
+                log.warning(f"Could not refresh {AUTH_STATE.name}: {e}")
+
+            # (page name, screenshot, label -> key map, instruction) — sent to Gemini together once every tab is captured
+            shots: List[Shot] = []
+
             # Capture timestamp once for file naming
             ts = int(time.time())
-            SCREENS_DIR.mkdir(parents=True, exist_ok=True)
             page_context = page # Start with the main page context
+            roi_map = load_roi_map()
 
             # --- Multi-Page Extraction Setup ---
+            # (tab button, screenshot suffix, label -> key map, instruction, label that marks the tab as loaded)
             pages_to_extract = [
                 # NPS Detail Page
                 ("NPS", "nps_detail", {
@@ -543,13 +956,15 @@ def run_daily_scrape():
                     "Click & Collect NPS": "click_collect_nps", "Internal Factors NPS": "colleague_happiness",
                     "External Factors NPS": "external_factors_nps", "Home Delivery NPS": "home_delivery_nps",
                     "Click & Collect Avg Wait": "cc_avg_wait"
-                }, "Extract the main numeric score (number only, ignore targets) for the titled NPS metrics. For NPS values, extract the main large number (e.g., '40', '73', '80'). For Click & Collect Avg Wait, extract the time format (M:SS)."),
+                }, "Extract the main numeric score (number only, ignore targets) for the titled NPS metrics. For NPS values, extract the main large number (e.g., '40', '73', '80'). For Click & Collect Avg Wait, extract the time format (M:SS).",
+                "Supermarket NPS"),
 
                 # Sales Detail Page
                 ("Sales", "sales_detail", {
                     "Sales Total": "sales_total", "vs Target": "sales_vs_target",
                     "LFL": "sales_lfl_detail"
-                }, "Extract the total Sales figure, the LFL percentage, and the vs Target figure. Include K or % in the output."),
+                }, "Extract the total Sales figure, the LFL percentage, and the vs Target figure. Include K or % in the output.",
+                "Sales Total"),
 
                 # Front End Detail Page
                 ("Front End", "fe_detail", {
@@ -558,25 +973,21 @@ def run_daily_scrape():
                     "Interventions": "interventions", "Interventions vs Target": "interventions_vs_target",
                     "Mainbank Closed": "mainbank_closed", "Mainbank Closed vs Target": "mainbank_vs_target",
                     "Swipe Rate": "swipe_rate", "Swipes WOW %": "swipes_wow_pct"
-                }, "Extract the numeric metric and its corresponding 'vs Target' metric where applicable. Include % for percentages. For numbers like 'Scan Rate' and 'Interventions' extract the integer/numeric value."),
+                }, "Extract the numeric metric and its corresponding 'vs Target' metric where applicable. Include % for percentages. For numbers like 'Scan Rate' and 'Interventions' extract the integer/numeric value.",
+                "SCO Utilisation"),
 
                 # Payroll Detail Page
                 ("Payroll", "payroll_detail", {
                     "Payroll Outturn": "payroll_outturn", "Absence Outturn": "absence_outturn",
                     "Productive Outturn": "productive_outturn", "Holiday Outturn": "holiday_outturn",
                     "Current Base Cost": "current_base_cost"
-                }, "Extract the numeric value (e.g., '753.6', '-1.4K') for the titled payroll outturn metrics."),
+                }, "Extract the numeric value (e.g., '753.6', '-1.4K') for the titled payroll outturn metrics.",
+                "Payroll Outturn"),
             ]
 
             # --- STEP 1: Extract Initial Context (Wheel Page) ---
-            log.info("Capturing screenshot of the initial Wheel page...")
-            screenshot_path_wheel = SCREENS_DIR / f"{ts}_wheel_page.png"
-            save_bytes(screenshot_path_wheel, page.screenshot(full_page=True, type="png"))
-
-            # Extract Context (Time/Store) from the whole page body
-            body_text = page.inner_text("body")
-            lines = [ln.rstrip() for ln in body_text.splitlines()]
-            all_metrics.update(parse_context_from_lines(lines))
+            # Extract Context (Time/Store) from the body text already read in open_and_prepare
+            all_metrics.update(parse_context(body_text))
 
             # Extract Wheel Metrics (Initial Pass - only keys on the wheel)
             prompt_map_wheel = {
@@ -587,40 +998,59 @@ def run_daily_scrape():
                 "NPS": "supermarket_nps", "Stock Record NPS": "stock_record"
             }
             system_inst_wheel = "You are a hyper-accurate retail dashboard data extractor. Extract the main metric (number + unit/K/%) next to each label on the 'Retail Steering Wheel'. For items in parentheses like (2.3K) return the value as -2.3K."
-            wheel_metrics = _extract_gemini_vision(screenshot_path_wheel, prompt_map_wheel, system_inst_wheel)
-            all_metrics.update(wheel_metrics)
+            log.info("Capturing screenshot of the initial Wheel page...")
+            screenshot_wheel = capture_screenshot(page, ts, "wheel_page", roi_map)
+            shots.append(("Wheel", screenshot_wheel, prompt_map_wheel, system_inst_wheel))
 
             # --- STEP 2: Iterate through detail pages ---
-            for tab_name, suffix, prompt_map, system_inst in pages_to_extract:
+            for tab_name, suffix, prompt_map, system_inst, marker in pages_to_extract:
                 log.info(f"Navigating to {tab_name} Detail page…")
 
                 # 2a. Click the tab - Now using robust wait-for and increased click timeout
+                before = dashboard_fingerprint(page)
                 try:
                     # Wait for the element to be visible before clicking
                     tab_locator = page.get_by_role("button", name=re.compile(tab_name, re.IGNORECASE)).last
                     tab_locator.wait_for(state="visible", timeout=15000)
                     tab_locator.click(timeout=10000)
-                    page.wait_for_timeout(6000)
                 except Exception as e:
                     log.warning(f"Failed to click {tab_name} tab. Skipping detail extraction for this page: {e}")
                     continue
 
-                # 2b. Screenshot Detail Page
+                # 2b. Wait for the tab's own content, then for charts to finish rendering
+                try:
+                    _dashboard_frame(page).get_by_text(marker).first.wait_for(state="visible", timeout=TAB_MARKER_TIMEOUT)
+                    marker_seen = True
+                except Exception:
+                    log.info(f"'{marker}' not visible after {TAB_MARKER_TIMEOUT // 1000}s — relying on render settle for {tab_name}.")
+                    marker_seen = False
+                wait_for_dashboard_settled(page, timeout_ms=9_000)
+                # Without the marker, an unchanged dashboard means we are still on the previous page —
+                # screenshotting it would send the wrong page to Gemini.
+                if not marker_seen and before is not None and dashboard_fingerprint(page) == before:
+                    log.warning(f"{tab_name} tab click did not change the dashboard. Skipping detail extraction for this page.")
+                    continue
                 log.info(f"Capturing screenshot for {tab_name} Detail…")
-                page.wait_for_timeout(3000)
-                screenshot_path = SCREENS_DIR / f"{ts}_{suffix}.png"
-                save_bytes(screenshot_path, page.screenshot(full_page=True, type="png"))
-
-                # 2c. Extract Metrics and Merge
-                page_metrics = _extract_gemini_vision(screenshot_path, prompt_map, system_inst)
-                all_metrics.update(page_metrics)
-
-            # --- STEP 3: Combine with default values for unextracted metrics ---
-            metrics_to_default = [key for key in CSV_HEADERS if key not in all_metrics]
-            for key in metrics_to_default:
-                all_metrics[key] = "—"
+                screenshot = capture_screenshot(page, ts, suffix, roi_map)
+
+                shots.append((tab_name, screenshot, prompt_map, system_inst))
+
+            # --- STEP 2c: Extract every page in a single multi-image request ---
+            combined, retry_shots = _extract_gemini_vision_combined(shots)
+            all_metrics.update(combined)
+            if retry_shots:
+                # Fall back to one request per failed or incomplete page. Gemini calls are network-bound
+                # and never touch Playwright, so they run on worker threads; merge in page order so later
+                # pages win.
+                if gemini_available() and GEMINI_API_KEY:
+                    log.info(f"Falling back to one Gemini request per page for: {', '.join(name for name, *_ in retry_shots)}.")
+                gemini_pool = ThreadPoolExecutor(max_workers=GEMINI_WORKERS, thread_name_prefix="gemini")
+                jobs = [gemini_pool.submit(_extract_gemini_vision, jpg, pm, si) for _, jpg, pm, si in retry_shots]
+                for job in jobs:
+                    all_metrics.update(job.result())
 
         finally:
+            if gemini_pool: gemini_pool.shutdown(wait=False, cancel_futures=True)
             if context: context.close()
             if browser: browser.close()
 
@@ -637,19 +1067,45 @@ def save_bytes(path: Path, data: bytes):
     except Exception as e:
         log.error(f"Failed to save screenshot {path.name}: {e}")
 
+def _get_session():
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _SESSION = requests.Session()
+        _SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=0))
+    return _SESSION
+
+def _jittered(delay: float) -> float:
+    # Spread retries over [delay/2, delay] so concurrent CI runs don't retry in lockstep
+    return random.uniform(delay * 0.5, delay)
+
 def _post_with_backoff(url: str, payload: dict) -> bool:
-    for i in range(4):
+    session = _get_session()
+    from requests.exceptions import RequestException
+    for i in range(WEBHOOK_ATTEMPTS):
+        retry_after = None
         try:
-            resp = requests.post(url, json=payload, timeout=20)
+            if orjson:
+                resp = session.post(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}, timeout=20)
+            else:
+                resp = session.post(url, json=payload, timeout=20)
             if 200 <= resp.status_code < 300:
                 log.info(f"Successfully posted to {url.split('?')[0]}...")
                 return True
             log.warning(f"POST to webhook failed with status {resp.status_code}: {resp.text}")
-        except requests.exceptions.RequestException as e:
+            if resp.status_code == 429:
+                retry_after = resp.headers.get("Retry-After")
+        except RequestException as e:
             log.error(f"POST to webhook failed with exception: {e}")
-        
-        wait_time = (2 ** i)
-        log.info(f"Retrying in {wait_time}s...")
+
+        if i == WEBHOOK_ATTEMPTS - 1:
+            break
+        try:
+            wait_time = min(float(retry_after), WEBHOOK_MAX_BACKOFF) + random.uniform(0, 1.0)
+        except (TypeError, ValueError):  # no header, or an HTTP-date we don't parse
+            wait_time = _jittered(2 ** i)
+        log.info(f"Retrying in {wait_time:.1f}s...")
         time.sleep(wait_time)
     return False
 